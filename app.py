@@ -8,7 +8,13 @@ It handles image processing, caching, and Q&A functionality using the Moondream
 Key Components:
     - FastAPI server with CORS support
     - Moondream model initialization and management
-    - Image encoding cache system
+    - Optional int8/nf4 weight-only quantization of the text decoder
+    - Image encoding cache system (fixed-size GPU embedding pool)
+    - torch.compile'd vision encoder replayed through CUDA Graphs
+    - Static-shape greedy decoder on pooled KV caches, one CUDA Graph per batch size and bucket
+    - Optional TensorRT vision encoder (see export_tensorrt.py)
+    - Dynamic batching of concurrent image encodes and generation requests
+    - One model replica per GPU, with separate encode and decode CUDA streams
     - RESTful endpoints for image description and Q&A
     - Health monitoring
 
@@ -17,29 +23,72 @@ Dependencies:
     - Transformers: For Moondream model
     - PyTorch: ML framework
     - Pillow: Image processing
-    - Python 3.8+
+    - uvloop + httptools: Faster event loop and HTTP parser (optional)
+    - bitsandbytes + accelerate: Only for QUANT=int8 or QUANT=nf4
+    - TensorRT: Only for the TensorRT vision encoder
+    - Python 3.9+
     - CUDA (optional but recommended)
 """
 
+import os
+
+# The CUDA caching allocator reads its config when torch initializes, so this has
+# to be set before torch (or transformers) is imported. Expandable segments stop
+# differently sized image embeddings and KV caches from fragmenting VRAM.
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,max_split_size_mb:128,garbage_collection_threshold:0.8",
+)
+
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    Cache,
+    TextStreamer,
+)
+from transformers.generation.streamers import BaseStreamer
 from PIL import Image
-import io
 import torch
-import json
+import orjson
 import time
+import asyncio
+import hashlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from fastapi.middleware.cors import CORSMiddleware
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Set up logging. Handlers only enqueue records; a background listener thread does
+# the stream writes so logging never blocks the event loop.
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener.start()
 logger = logging.getLogger(__name__)
 
+# Prefer uvloop's event loop. Uvicorn already selects it when installed; this covers
+# other launchers. uvloop is not available on Windows, where asyncio's loop is kept.
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 app = FastAPI(
     title="Moondream API",
     description="Local API server for Moondream vision language model",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson for the final dump of any response a handler doesn't build itself.
+    # FastAPI still runs jsonable_encoder on returned dicts, so the hot handlers
+    # return ORJSONResponse instances, which are sent as-is.
+    default_response_class=ORJSONResponse
 )
 
 # CORS configuration
@@ -56,23 +105,1126 @@ print("Loading model and tokenizer...")
 model_id = "vikhyatk/moondream2"
 revision = "2024-07-23"
 
+# Device facts don't change after startup, so query them once
+CUDA_AVAILABLE = torch.cuda.is_available()
+DEVICE_NAME = torch.cuda.get_device_name(0) if CUDA_AVAILABLE else None
+
+# CUDA Graph configuration. Set DISABLE_CUDAGRAPH=1 to run the vision encoder and
+# the decode steps eagerly (useful when debugging model code or profiling
+# individual kernels).
+DISABLE_CUDAGRAPH = os.environ.get("DISABLE_CUDAGRAPH", "0").lower() in ("1", "true", "yes")
+MAX_NEW_TOKENS = 512
+# Total sequence lengths (image tokens + prompt + generated tokens) that get their
+# own static KV cache. The image and prompt template alone are ~741 positions, so
+# with MAX_NEW_TOKENS every request needs more than 1024, and Moondream's decoder
+# tops out at 2048 positions.
+SEQ_BUCKETS = (1536, 2048)
+
+# Dynamic batching configuration
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT_MS = float(os.environ.get("MAX_BATCH_WAIT_MS", "15"))
+
+# KV cache budget in tokens, summed over the batch, allocated once at startup.
+# When unset it is sized from free GPU memory (see kv_cache_capacity).
+KV_CACHE_TOKENS = os.environ.get("KV_CACHE_TOKENS")
+
+
+def seq_bucket(seq_len):
+    """Return the smallest bucket that fits seq_len, or None if none does."""
+    for bucket in SEQ_BUCKETS:
+        if seq_len <= bucket:
+            return bucket
+    return None
+
+
+class BucketKVCache(Cache):
+    """
+    Fixed-length KV cache over views of the pool's buffer.
+
+    The prefill writes the prompt at the start of the buffer and attends to
+    just that. Once `decoding` is set, each step writes its token at
+    write_position, a device tensor, attends to the whole buffer, and reports
+    a constant past length of bucket - 1. So every decode step has the same
+    shapes and addresses, and the attention mask hides the columns not written
+    yet. Stale values from earlier requests are always masked or overwritten,
+    so the cache is never cleared.
+    """
+
+    def __init__(self, key_cache, value_cache):
+        super().__init__()
+        self.key_cache = key_cache
+        self.value_cache = value_cache
+        self.bucket = key_cache[0].shape[2]
+        self.write_position = torch.zeros(1, dtype=torch.long, device=key_cache[0].device)
+        self.decoding = False
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        keys, values = self.key_cache[layer_idx], self.value_cache[layer_idx]
+        if not self.decoding:
+            length = key_states.shape[2]
+            keys[:, :, :length].copy_(key_states)
+            values[:, :, :length].copy_(value_states)
+            return keys[:, :, :length], values[:, :, :length]
+        keys.index_copy_(2, self.write_position, key_states)
+        values.index_copy_(2, self.write_position, value_states)
+        return keys, values
+
+    def get_seq_length(self, layer_idx=0):
+        return self.bucket - 1 if self.decoding else 0
+
+    def get_max_cache_shape(self):
+        return None
+
+
+class KVCachePool:
+    """
+    Static KV caches carved out of one buffer allocated at startup.
+
+    Each (batch size, length bucket) pair gets a BucketKVCache whose key/value
+    tensors are contiguous views into the shared buffer, so decoding never
+    allocates a KV cache and total KV memory is fixed at `capacity` tokens.
+    The views alias each other, which is safe because each replica decodes
+    one batch at a time on its decode thread.
+    """
+
+    def __init__(self, text_model, capacity):
+        config = text_model.config
+        param = next(text_model.parameters())
+        self.capacity = capacity
+        self.num_heads, self.head_dim = self.kv_shape(config)
+        self.buffer = torch.zeros(
+            (config.num_hidden_layers, 2, capacity * self.num_heads * self.head_dim),
+            dtype=param.dtype,
+            device=param.device,
+        )
+        self.caches = {}
+
+    @staticmethod
+    def kv_shape(config):
+        """(key/value heads, head dim) of the decoder's attention layers."""
+        num_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        return num_heads, head_dim
+
+    @classmethod
+    def bytes_per_token(cls, text_model):
+        """KV cache memory one token takes across every layer."""
+        num_heads, head_dim = cls.kv_shape(text_model.config)
+        itemsize = next(text_model.parameters()).element_size()
+        return text_model.config.num_hidden_layers * 2 * num_heads * head_dim * itemsize
+
+    def max_batch_size(self, bucket):
+        """Largest batch whose cache for this bucket fits in the buffer."""
+        return self.capacity // bucket
+
+    def cache_for(self, batch_size, bucket):
+        """Return the KV cache for a batch size and bucket, ready for a prefill."""
+        cache = self.caches.get((batch_size, bucket))
+        if cache is None:
+            shape = (batch_size, self.num_heads, bucket, self.head_dim)
+            size = batch_size * self.num_heads * bucket * self.head_dim
+            cache = BucketKVCache(
+                [layer[0, :size].view(shape) for layer in self.buffer],
+                [layer[1, :size].view(shape) for layer in self.buffer],
+            )
+            self.caches[(batch_size, bucket)] = cache
+        cache.decoding = False
+        return cache
+
+
+class DecodeStep:
+    """
+    One greedy decode step for a fixed batch size and bucket.
+
+    The step reads its inputs from static tensors (input_ids, position_ids,
+    attention_mask and the cache's write_position) and leaves the next tokens
+    in next_ids. Once captured, run() replays a CUDA Graph of the whole step
+    instead of launching every kernel from Python.
+    """
+
+    def __init__(self, text_model, cache):
+        device = cache.write_position.device
+        batch_size = cache.key_cache[0].shape[0]
+        self.text_model = text_model
+        self.cache = cache
+        self.input_ids = torch.zeros((batch_size, 1), dtype=torch.long, device=device)
+        self.position_ids = torch.zeros((batch_size, 1), dtype=torch.long, device=device)
+        self.attention_mask = torch.zeros((batch_size, cache.bucket), dtype=torch.long, device=device)
+        self.next_ids = None
+        self.graph = None
+
+    def forward(self):
+        logits = self.text_model(
+            input_ids=self.input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=self.position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        ).logits
+        return logits[:, -1].argmax(-1)
+
+    def capture(self, pool):
+        """Record the step as a CUDA Graph, after warming up on a side stream."""
+        device = self.cache.write_position.device
+        self.cache.decoding = True
+        self.attention_mask[:, 0] = 1
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(2):
+                self.forward()
+        torch.cuda.current_stream(device).wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=pool):
+            self.next_ids = self.forward()
+        self.graph = graph
+
+    def run(self):
+        if self.graph is None:
+            return self.forward()
+        self.graph.replay()
+        return self.next_ids
+
+
+class StaticDecoder:
+    """
+    Greedy decoding on pooled, fixed-shape KV caches.
+
+    The prompt is prefilled eagerly, then every generated token runs the
+    DecodeStep for the batch size and bucket. With graphs captured, that is
+    one CUDA Graph replay per token. Output matches generate() with greedy
+    decoding: the end-of-text token is kept, and finished rows are padded
+    with pad_token_id.
+    """
+
+    def __init__(self, text_model, kv_caches):
+        self.text_model = text_model
+        self.kv_caches = kv_caches
+        self.steps = {}
+        self.graphs_captured = False
+
+    def step_for(self, batch_size, bucket):
+        step = self.steps.get((batch_size, bucket))
+        if step is None:
+            step = DecodeStep(self.text_model, self.kv_caches.cache_for(batch_size, bucket))
+            self.steps[(batch_size, bucket)] = step
+        return step
+
+    def capture(self):
+        """Capture a graph for every batch size the batcher can send, in every bucket."""
+        # One decode runs at a time per replica and each replay rewrites its
+        # intermediates before reading them, so all graphs share one pool
+        pool = torch.cuda.graph_pool_handle()
+        try:
+            for bucket in SEQ_BUCKETS:
+                for batch_size in range(1, min(MAX_BATCH_SIZE, self.kv_caches.max_batch_size(bucket)) + 1):
+                    self.step_for(batch_size, bucket).capture(pool)
+        except Exception:
+            self.release_graphs()
+            raise
+        self.graphs_captured = True
+
+    def release_graphs(self):
+        for step in self.steps.values():
+            step.graph = None
+            step.next_ids = None
+        self.graphs_captured = False
+
+    def generate(self, inputs_embeds, attention_mask, max_new_tokens, bucket,
+                 eos_token_id, pad_token_id, streamer=None):
+        """
+        Decode a left-padded batch of prompt embeddings in the given bucket.
+
+        Returns one 1-D tensor of generated ids per row. A streamer gets the
+        same put()/end() calls generate() would make.
+        """
+        batch_size, prompt_len = attention_mask.shape
+        step = self.step_for(batch_size, bucket)
+        cache = self.kv_caches.cache_for(batch_size, bucket)
+        with torch.inference_mode():
+            # Same positions generate() derives from a left-padded mask
+            positions = attention_mask.cumsum(-1) - 1
+            positions.masked_fill_(attention_mask == 0, 1)
+            logits = self.text_model(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                position_ids=positions,
+                past_key_values=cache,
+                use_cache=True,
+            ).logits
+            next_ids = logits[:, -1].argmax(-1)
+
+            cache.decoding = True
+            step.attention_mask.zero_()
+            step.attention_mask[:, :prompt_len] = attention_mask
+            step.position_ids.copy_(positions[:, -1:])
+            if streamer is not None:
+                streamer.put(torch.empty((batch_size, 0), dtype=torch.long))
+            finished = torch.zeros(batch_size, dtype=torch.bool, device=next_ids.device)
+            tokens = []
+            for i in range(max_new_tokens):
+                next_ids = next_ids.masked_fill(finished, pad_token_id)
+                tokens.append(next_ids)
+                if streamer is not None:
+                    streamer.put(next_ids.cpu())
+                finished |= next_ids == eos_token_id
+                if i == max_new_tokens - 1 or bool(finished.all()):
+                    break
+                # Feed this token at the next column of the cache
+                column = prompt_len + i
+                step.input_ids.copy_(next_ids[:, None])
+                step.position_ids.add_(1)
+                step.attention_mask[:, column] = 1
+                cache.write_position.fill_(column)
+                next_ids = step.run()
+        if streamer is not None:
+            streamer.end()
+        return list(torch.stack(tokens, dim=1))
+
+
+# TensorRT engine for the ViT, built by export_tensorrt.py. Used when the file exists.
+TRT_VISION_ENGINE = os.environ.get("TRT_VISION_ENGINE", "moondream_vision.plan")
+
+
+class TensorRTVisionEncoder(torch.nn.Module):
+    """
+    Drop-in replacement for vision_encoder.encoder that runs a TensorRT engine.
+
+    The engine executes on the caller's current CUDA stream. Inputs with more
+    crops than the engine's optimization profile allows are run in chunks,
+    each into its own output tensor.
+    """
+
+    def __init__(self, engine_path, device):
+        super().__init__()
+        import tensorrt as trt
+
+        runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+        with open(engine_path, "rb") as f, torch.cuda.device(device):
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+            if self.engine is None:
+                raise RuntimeError(f"Could not deserialize TensorRT engine {engine_path}")
+            self.context = self.engine.create_execution_context()
+        # (min, opt, max) input shapes of the engine's first profile
+        self.max_crops = self.engine.get_tensor_profile_shape("pixel_values", 0)[2][0]
+        self.device = device
+
+    def forward(self, pixel_values):
+        if pixel_values.shape[0] > self.max_crops:
+            return torch.cat([self(chunk) for chunk in pixel_values.split(self.max_crops)])
+        dtype = pixel_values.dtype
+        pixel_values = pixel_values.to(self.device, torch.float16).contiguous()
+        self.context.set_input_shape("pixel_values", tuple(pixel_values.shape))
+        shape = tuple(self.context.get_tensor_shape("image_features"))
+        output = torch.empty(shape, dtype=torch.float16, device=self.device)
+        self.context.set_tensor_address("pixel_values", pixel_values.data_ptr())
+        self.context.set_tensor_address("image_features", output.data_ptr())
+        self.context.execute_async_v3(torch.cuda.current_stream(self.device).cuda_stream)
+        return output.to(dtype)
+
+
+# Weight precision: fp16, bf16, or bitsandbytes int8/nf4 weight-only quantization
+# of the text decoder (the vision encoder and output head stay in fp16).
+# Defaults to bf16 on Ampere and newer GPUs, where it is as fast as fp16 but
+# can't overflow, and fp16 elsewhere.
+BF16_SUPPORTED = CUDA_AVAILABLE and torch.cuda.get_device_capability()[0] >= 8
+QUANT = os.environ.get("QUANT", "bf16" if BF16_SUPPORTED else "fp16").lower()
+if QUANT not in ("fp16", "bf16", "int8", "nf4"):
+    raise ValueError(f"Unsupported QUANT={QUANT!r}, expected one of fp16, bf16, int8, nf4")
+
+if CUDA_AVAILABLE:
+    # TF32 for the residual fp32 matmuls/convolutions, autotuned cuDNN kernels,
+    # and the fused SDPA attention backends
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.enable_flash_sdp(True)
+    torch.backends.cuda.enable_mem_efficient_sdp(True)
+
+
+# Modules kept in full precision. Setting llm_int8_skip_modules replaces
+# transformers' default skip list, so the output head has to be listed too.
+QUANT_SKIP_MODULES = ["vision_encoder", "lm_head"]
+
+
+def quantization_config():
+    """Build the bitsandbytes config for QUANT, or None for unquantized loads."""
+    if QUANT == "int8":
+        return BitsAndBytesConfig(
+            load_in_8bit=True,
+            llm_int8_threshold=6.0,
+            llm_int8_skip_modules=QUANT_SKIP_MODULES,
+        )
+    if QUANT == "nf4":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            llm_int8_skip_modules=QUANT_SKIP_MODULES,
+        )
+    return None
+
+
+# Fraction of GPU memory this process may allocate
+CUDA_MEMORY_FRACTION = float(os.environ.get("CUDA_MEMORY_FRACTION", "0.85"))
+
+
+
+def load_model(device_index):
+    """Load one copy of Moondream onto a CUDA device, or the CPU if device_index is None."""
+    load_kwargs = {
+        "trust_remote_code": True,
+        "revision": revision,
+        "torch_dtype": torch.bfloat16 if QUANT == "bf16" else torch.float16,
+    }
+    quant_config = quantization_config()
+    if quant_config is not None:
+        if device_index is None:
+            raise RuntimeError(f"QUANT={QUANT} requires a CUDA device")
+        # bitsandbytes places weights at load time; quantized models can't be moved with .to()
+        load_kwargs["quantization_config"] = quant_config
+        load_kwargs["device_map"] = {"": device_index}
+    model = AutoModelForCausalLM.from_pretrained(model_id, **load_kwargs)
+    if device_index is not None and quant_config is None:
+        model = model.to(f"cuda:{device_index}")
+    return model
+
+
+class ModelReplica:
+    """
+    One copy of the model on one device.
+
+    Image encoding and text decoding each get a dedicated thread and, on GPUs,
+    their own CUDA stream, so the vision encode of the next batch overlaps the
+    decode of the current one. Running every call for a stage on the same
+    thread also means the vision encoder's CUDA Graphs are replayed from the
+    thread that recorded them.
+    """
+
+    def __init__(self, index, device_index):
+        self.index = index
+        self.model = load_model(device_index)
+        self.device = torch.device("cpu" if device_index is None else f"cuda:{device_index}")
+        self.encode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"encode-{index}")
+        self.decode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"decode-{index}")
+        if device_index is None:
+            self.encode_stream = self.decode_stream = None
+        else:
+            self.encode_stream = torch.cuda.Stream(device=self.device)
+            self.decode_stream = torch.cuda.Stream(device=self.device)
+        self.vision_compiled = False
+        self.vision_tensorrt = False
+        self.decoder = None
+
+    def _call(self, stream, fn, args):
+        if stream is None:
+            return fn(self, *args)
+        with torch.cuda.device(self.device), torch.cuda.stream(stream):
+            return fn(self, *args)
+
+    def submit_encode(self, fn, *args):
+        """Run fn(replica, *args) on the encode thread and stream."""
+        return self.encode_executor.submit(self._call, self.encode_stream, fn, args)
+
+    def submit_decode(self, fn, *args):
+        """Run fn(replica, *args) on the decode thread and stream."""
+        return self.decode_executor.submit(self._call, self.decode_stream, fn, args)
+
+    async def encode(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_encode(fn, *args))
+
+    async def decode(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_decode(fn, *args))
+
+
+# One replica per visible GPU (restrict with CUDA_VISIBLE_DEVICES), or one on the CPU
+device_indices = list(range(torch.cuda.device_count())) if CUDA_AVAILABLE else [None]
+
 try:
-    model = AutoModelForCausalLM.from_pretrained(
-        model_id,
-        trust_remote_code=True,
-        revision=revision,
-        torch_dtype=torch.float16,
-    )
-    if torch.cuda.is_available():
-        model = model.to("cuda")
     tokenizer = AutoTokenizer.from_pretrained(model_id, revision=revision)
-    print("Model and tokenizer loaded successfully")
+    replicas = [ModelReplica(index, device_index) for index, device_index in enumerate(device_indices)]
+    print(f"Model and tokenizer loaded successfully ({QUANT}, {len(replicas)} replica(s))")
+    if CUDA_AVAILABLE:
+        # Cap the allocator so sustained load can't grow the cache past the working set
+        for device_index in device_indices:
+            torch.cuda.set_per_process_memory_fraction(CUDA_MEMORY_FRACTION, device_index)
 except Exception as e:
     print(f"Error loading model: {str(e)}")
     raise
 
-# Store encoded images temporarily
-encoded_images = {}
+# The first replica also handles preprocessing and hosts the image embedding pool
+model = replicas[0].model
+MODEL_DEVICE = str(replicas[0].device)
+MODEL_DTYPE = str(next(model.parameters()).dtype)
+print(f"Primary device: {MODEL_DEVICE} ({DEVICE_NAME or 'CPU'}, {MODEL_DTYPE})")
+
+
+def cuda_probe(device):
+    """Run a tiny copy and kernel on the device and report whether it worked."""
+    try:
+        x = torch.rand(5, 3).to(device) * 2
+        torch.cuda.synchronize(device)
+        return f"passed ({tuple(x.shape)} tensor on {x.device})"
+    except Exception as e:
+        return f"failed: {str(e)}"
+
+
+# Probed once here, per replica device; /health reports the cached results
+# unless asked for a live probe
+CUDA_TEST_RESULT = {
+    str(replica.device): cuda_probe(replica.device) for replica in replicas if CUDA_AVAILABLE
+}
+for device, result in CUDA_TEST_RESULT.items():
+    print(f"CUDA test ({device}): {result}")
+
+
+def generation_config():
+    """Generation arguments shared by every decoder call."""
+    return {
+        "eos_token_id": tokenizer.eos_token_id,
+        "bos_token_id": tokenizer.bos_token_id,
+        "pad_token_id": tokenizer.bos_token_id,
+    }
+
+
+def build_prompt(question):
+    """Moondream's question-answering prompt template."""
+    return f"<image>\n\nQuestion: {question}\n\nAnswer:"
+
+
+def encode_image(replica, image):
+    """Run the vision encoder on a PIL image or a preprocessed pixel tensor."""
+    with torch.inference_mode():
+        return replica.model.encode_image([image])
+
+
+def encode_images(replica, images):
+    """
+    Encode several images with a single vision encoder call.
+
+    Moondream stacks the crops of every image into one [N, 3, 378, 378] batch
+    before the ViT, so this runs one patch-embed and one pass through each
+    transformer block instead of one per image. Pinned pixel tensors are
+    uploaded on the encode stream. Returns one [1, seq, dim] embedding per
+    image.
+    """
+    with torch.inference_mode():
+        images = [
+            image.to(replica.device, non_blocking=True) if isinstance(image, torch.Tensor) else image
+            for image in images
+        ]
+        embeds = replica.model.encode_image(images)
+    if replica.encode_stream is not None:
+        # The embeddings are read from other streams and threads from here on
+        replica.encode_stream.synchronize()
+    return [embeds[i:i + 1] for i in range(len(images))]
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    Fans a batched generate() stream out to one streamer per row.
+
+    Rows without a streamer are None. Each row's streamer gets that row's
+    tokens with a batch size of 1, and is ended as soon as the row emits the
+    end-of-text token rather than when the whole batch finishes.
+    """
+
+    def __init__(self, streamers, eos_token_id):
+        self.streamers = list(streamers)
+        self.eos_token_id = eos_token_id
+
+    def put(self, value):
+        for i, streamer in enumerate(self.streamers):
+            if streamer is None:
+                continue
+            row = value[i:i + 1]
+            streamer.put(row)
+            if row.numel() and int(row.reshape(-1)[-1]) == self.eos_token_id:
+                streamer.end()
+                self.streamers[i] = None
+
+    def end(self):
+        for i, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.end()
+                self.streamers[i] = None
+
+
+def batch_streamer(streamers, eos_token_id):
+    """A BatchStreamer over the rows' streamers, or None if no row streams."""
+    if streamers is None or all(streamer is None for streamer in streamers):
+        return None
+    return BatchStreamer(streamers, eos_token_id)
+
+
+def run_decoder(replica, inputs_embeds, attention_mask, max_new_tokens, streamers=None, **generate_config):
+    """
+    Generate from a batch of prompt embeddings with the replica's static decoder.
+
+    Batches are split when they don't fit the KV budget. Sequences longer than
+    the largest bucket, or a replica without a static decoder, fall back to
+    generate() and its own cache. streamers holds an optional streamer per row.
+
+    Returns one 1-D tensor of generated ids per row.
+    """
+    decoder = replica.decoder
+    eos_token_id = generate_config["eos_token_id"]
+    bucket = seq_bucket(inputs_embeds.shape[1] + max_new_tokens)
+    if decoder is None or bucket is None:
+        return list(replica.model.text_model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            max_new_tokens=max_new_tokens,
+            streamer=batch_streamer(streamers, eos_token_id),
+            **generate_config,
+        ))
+
+    max_rows = min(MAX_BATCH_SIZE, decoder.kv_caches.max_batch_size(bucket))
+    output_ids = []
+    for start in range(0, inputs_embeds.shape[0], max_rows):
+        output_ids.extend(decoder.generate(
+            inputs_embeds[start:start + max_rows],
+            attention_mask[start:start + max_rows],
+            max_new_tokens,
+            bucket,
+            eos_token_id=eos_token_id,
+            pad_token_id=generate_config["pad_token_id"],
+            streamer=batch_streamer(streamers and streamers[start:start + max_rows], eos_token_id),
+        ))
+    return output_ids
+
+
+def build_inputs(replica, image_embeds, questions):
+    """
+    Embed one prompt per image and left-pad them into a batch.
+
+    Mirrors Moondream's batch_answer: each prompt is embedded separately and
+    left-padded with the BOS embedding to a common length.
+
+    Returns (prompt_embeds, inputs_embeds, attention_mask).
+    """
+    prompt_embeds = [
+        replica.model.input_embeds(
+            build_prompt(question), embeds.to(replica.device, non_blocking=True), tokenizer
+        )[0]
+        for embeds, question in zip(image_embeds, questions)
+    ]
+    max_len = max(embeds.shape[0] for embeds in prompt_embeds)
+    bos_embed = prompt_embeds[0][:1]
+    inputs_embeds = torch.stack([
+        torch.cat([bos_embed.expand(max_len - embeds.shape[0], -1), embeds])
+        for embeds in prompt_embeds
+    ])
+    attention_mask = torch.zeros(
+        inputs_embeds.shape[:2], dtype=torch.long, device=inputs_embeds.device
+    )
+    for i, embeds in enumerate(prompt_embeds):
+        attention_mask[i, max_len - embeds.shape[0]:] = 1
+    return prompt_embeds, inputs_embeds, attention_mask
+
+
+def answer_questions(replica, image_embeds, questions, max_new_tokens=MAX_NEW_TOKENS, streamers=None):
+    """
+    Answer a batch of questions, one per encoded image.
+
+    streamers optionally holds one streamer (or None) per question; each
+    receives its own row's tokens as they are decoded, alongside the rest of
+    the batch.
+
+    Returns a list of (answer, usage) tuples. Usage counts are exact decoder
+    positions: prompt_tokens includes the image embedding, completion_tokens
+    excludes padding and the end-of-text token.
+    """
+    generate_config = generation_config()
+    with torch.inference_mode():
+        if replica.decode_stream is not None:
+            # Cached embeddings are written to the pool on the default stream
+            replica.decode_stream.wait_stream(torch.cuda.default_stream(replica.device))
+        prompt_embeds, inputs_embeds, attention_mask = build_inputs(replica, image_embeds, questions)
+        output_ids = run_decoder(
+            replica, inputs_embeds, attention_mask, max_new_tokens, streamers, **generate_config
+        )
+    answers = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+    # Finished rows are padded with the pad/EOS id, so every other id is a real token
+    completion_tokens = [int((ids != tokenizer.bos_token_id).sum()) for ids in output_ids]
+    return [
+        (answer.strip(), {
+            "prompt_tokens": embeds.shape[0],
+            "completion_tokens": completion,
+            "total_tokens": embeds.shape[0] + completion,
+        })
+        for answer, embeds, completion in zip(answers, prompt_embeds, completion_tokens)
+    ]
+
+
+# Image embedding pool configuration
+IMAGE_POOL_SLOTS = int(os.environ.get("IMAGE_POOL_SLOTS", "32"))
+IMAGE_TTL_SECONDS = float(os.environ.get("IMAGE_TTL_SECONDS", "600"))
+IMAGE_SWEEP_INTERVAL_SECONDS = 60
+
+
+class ImageEmbeddingPool:
+    """
+    Fixed-size pool of image embeddings, allocated once on the model device.
+
+    Encoded images are copied into a free slot of one pre-allocated tensor
+    instead of being kept alive as individual allocations, so VRAM use is
+    bounded and /describe never grows the caching allocator. When the pool is
+    full the least recently used image is evicted. Images are keyed by a hash
+    of their contents, so the generated description is cached alongside the
+    embedding.
+
+    Requests read slots in place. A slot is pinned from acquire() until
+    release(), and pinned slots are never evicted or swept, so a request
+    waiting in the batcher can't have its image replaced underneath it.
+    """
+
+    def __init__(self, n_slots, embed_shape, dtype, device):
+        self.embeddings = torch.empty((n_slots, *embed_shape), dtype=dtype, device=device)
+        self.free_slots = list(range(n_slots))
+        # image_key -> (slot, last_used), least recently used first
+        self.slots = OrderedDict()
+        # image_key -> (description, usage) for images that have been described
+        self.descriptions = {}
+        # slot -> number of requests currently using it
+        self.pins = {}
+
+    def store(self, image_key, enc_image):
+        """
+        Copy an encoded image into a slot and register it under image_key.
+
+        Returns False, without caching, when every slot is pinned.
+        """
+        if image_key in self.slots:
+            # Same key means same contents; the slot already holds this image
+            self.touch(image_key)
+            return True
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            # Least recently used image that no request is reading
+            evicted_key = next(
+                (key for key, (used_slot, _) in self.slots.items() if used_slot not in self.pins), None
+            )
+            if evicted_key is None:
+                return False
+            slot, _ = self.slots.pop(evicted_key)
+            self.descriptions.pop(evicted_key, None)
+        self.embeddings[slot].copy_(enc_image[0], non_blocking=True)
+        self.slots[image_key] = (slot, time.monotonic())
+        return True
+
+    def touch(self, image_key):
+        """Mark image_key as recently used and return its slot, or None."""
+        entry = self.slots.get(image_key)
+        if entry is None:
+            return None
+        slot = entry[0]
+        self.slots[image_key] = (slot, time.monotonic())
+        self.slots.move_to_end(image_key)
+        return slot
+
+    def acquire(self, image_key):
+        """
+        Pin the slot for image_key and return (embedding, slot), or None.
+
+        The embedding is a [1, seq, dim] view of the slot. Pass the slot to
+        release() once the request no longer reads it.
+        """
+        slot = self.touch(image_key)
+        if slot is None:
+            return None
+        self.pins[slot] = self.pins.get(slot, 0) + 1
+        return self.embeddings[slot:slot + 1], slot
+
+    def release(self, slot):
+        """Unpin a slot returned by acquire(). None is ignored."""
+        if slot not in self.pins:
+            return
+        self.pins[slot] -= 1
+        if not self.pins[slot]:
+            del self.pins[slot]
+
+    def sweep(self, ttl):
+        """Free every unpinned slot that hasn't been used for ttl seconds."""
+        cutoff = time.monotonic() - ttl
+        for image_key, (slot, last_used) in list(self.slots.items()):
+            if last_used > cutoff:
+                break
+            if slot in self.pins:
+                continue
+            del self.slots[image_key]
+            self.descriptions.pop(image_key, None)
+            self.free_slots.append(slot)
+
+    def get_description(self, image_key):
+        """Return the cached (description, usage) for image_key, or None."""
+        if image_key not in self.descriptions:
+            return None
+        self.touch(image_key)
+        return self.descriptions[image_key]
+
+    def set_description(self, image_key, description, usage):
+        if image_key in self.slots:
+            self.descriptions[image_key] = (description, usage)
+
+    def clear(self):
+        self.free_slots = list(range(self.embeddings.shape[0]))
+        self.slots.clear()
+        self.descriptions.clear()
+        self.pins.clear()
+
+
+# Crop counts the compiled ViT is specialized to. Each image is split into 1-5
+# 378x378 crops (a global view plus up to four tiles) and up to 8 images are
+# encoded together; other counts are zero-padded up to the next size.
+VISION_CROP_BUCKETS = (1, 5, 10, 20, 40)
+
+
+class PaddedVisionEncoder(torch.nn.Module):
+    """
+    Runs a torch.compile'd ViT on a fixed set of crop counts.
+
+    The number of crops depends on each image's size and on how many uploads
+    were batched, so compiling for whatever count arrives would recompile and
+    record a new CUDA Graph inside user requests. Instead crops are padded to
+    the next VISION_CROP_BUCKETS size, every size is recorded at startup, and
+    the padding rows are sliced off the output.
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+        self.compiled = torch.compile(encoder, mode="reduce-overhead", fullgraph=False, dynamic=False)
+
+    def forward(self, pixel_values):
+        crops = pixel_values.shape[0]
+        bucket = next((size for size in VISION_CROP_BUCKETS if size >= crops), None)
+        if bucket is None:
+            # Every chunk replays the largest bucket's graph, which overwrites the
+            # previous replay's output, so each chunk is copied out before the next
+            chunks = []
+            for chunk in pixel_values.split(VISION_CROP_BUCKETS[-1]):
+                torch.compiler.cudagraph_mark_step_begin()
+                chunks.append(self(chunk).clone())
+            return torch.cat(chunks)
+        if bucket > crops:
+            padding = pixel_values.new_zeros((bucket - crops, *pixel_values.shape[1:]))
+            pixel_values = torch.cat([pixel_values, padding])
+        return self.compiled(pixel_values)[:crops]
+
+
+def compile_vision_encoder(replica):
+    """
+    Compile the ViT with CUDA Graphs, one per crop-count bucket.
+
+    Preprocessing in the vision encoder works on PIL images, so only the
+    tensor-only ViT stack is compiled.
+    """
+    vision_encoder = replica.model.vision_encoder
+    if hasattr(vision_encoder, "encoder"):
+        vision_encoder.encoder = PaddedVisionEncoder(vision_encoder.encoder)
+        replica.vision_compiled = True
+
+
+def warmup_vision_encoder(replica):
+    """
+    Run the ViT on every crop bucket enough times to compile and record its
+    graphs, then encode a blank image.
+    """
+    if replica.vision_compiled:
+        encoder = replica.model.vision_encoder.encoder
+        dtype = next(encoder.parameters()).dtype
+        with torch.inference_mode():
+            for crops in VISION_CROP_BUCKETS:
+                pixels = torch.zeros((crops, 3, 378, 378), dtype=dtype, device=replica.device)
+                for _ in range(3):
+                    encoder(pixels)
+    return encode_image(replica, Image.new("RGB", (378, 378)))
+
+
+def verify_static_decoder(replica, decoder, image_embeds):
+    """
+    Check that the static decoder reproduces generate().
+
+    Greedy-decodes a few tokens from the probe image with generate()'s own
+    cache and with the static decoder, one prompt in every bucket plus a
+    left-padded pair of prompts, and raises if any of them fails or
+    disagrees. This also warms up the decoder.
+    """
+    cases = [(["Describe this image."], bucket) for bucket in SEQ_BUCKETS]
+    cases.append((["Describe this image.", "What is the main color of this image?"], SEQ_BUCKETS[0]))
+    config = generation_config()
+    with torch.inference_mode():
+        for questions, bucket in cases:
+            _, inputs_embeds, attention_mask = build_inputs(
+                replica, [image_embeds] * len(questions), questions
+            )
+            expected = replica.model.text_model.generate(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                max_new_tokens=8,
+                **config,
+            )
+            output = decoder.generate(
+                inputs_embeds,
+                attention_mask,
+                8,
+                bucket,
+                eos_token_id=config["eos_token_id"],
+                pad_token_id=config["pad_token_id"],
+            )
+            output = torch.stack(output)
+            if output.shape != expected.shape or not torch.equal(output, expected):
+                raise RuntimeError(
+                    f"static decoding in the {bucket}-token bucket gave different tokens"
+                )
+    if replica.decode_stream is not None:
+        replica.decode_stream.synchronize()
+
+
+def capture_decoder_graphs(replica, decoder):
+    """Capture the decoder's CUDA Graphs on the replica's decode thread."""
+    decoder.capture()
+
+
+def kv_cache_capacity(replica):
+    """
+    Tokens to give the replica's KV cache pool.
+
+    KV_CACHE_TOKENS when set. Otherwise enough for a full batch in the
+    smallest bucket, which every request uses unless its question is unusually
+    long, capped at half the memory still available under the
+    CUDA_MEMORY_FRACTION cap. Never less than one full-length sequence.
+    """
+    if KV_CACHE_TOKENS:
+        return max(int(KV_CACHE_TOKENS), SEQ_BUCKETS[-1])
+    capacity = MAX_BATCH_SIZE * SEQ_BUCKETS[0]
+    if replica.device.type == "cuda":
+        free, total = torch.cuda.mem_get_info(replica.device)
+        headroom = min(free, CUDA_MEMORY_FRACTION * total - torch.cuda.memory_reserved(replica.device))
+        capacity = min(capacity, int(headroom / 2 / KVCachePool.bytes_per_token(replica.model.text_model)))
+    return max(capacity, SEQ_BUCKETS[-1])
+
+
+def prepare_replica(replica):
+    """
+    Compile and warm up a freshly loaded replica so the first user request
+    doesn't pay for it, and set up its static decoder.
+
+    Returns the embedding of a blank probe image.
+    """
+    use_graphs = CUDA_AVAILABLE and not DISABLE_CUDAGRAPH
+    eager_encoder = getattr(replica.model.vision_encoder, "encoder", None)
+    if CUDA_AVAILABLE and os.path.exists(TRT_VISION_ENGINE):
+        try:
+            replica.model.vision_encoder.encoder = TensorRTVisionEncoder(TRT_VISION_ENGINE, replica.device)
+            replica.vision_tensorrt = True
+            print(f"Using TensorRT vision encoder ({replica.device})")
+        except Exception as e:
+            logger.warning(f"Could not load TensorRT engine, using PyTorch vision encoder: {str(e)}")
+    if use_graphs and not replica.vision_tensorrt:
+        compile_vision_encoder(replica)
+
+    print(f"Warming up vision encoder ({replica.device})...")
+    try:
+        probe = replica.submit_encode(warmup_vision_encoder).result()
+    except Exception as e:
+        if not (replica.vision_compiled or replica.vision_tensorrt):
+            raise
+        # e.g. no Triton for inductor on Windows, or an engine built for another GPU
+        logger.warning(f"Accelerated vision encoder failed, running it eagerly: {str(e)}")
+        replica.model.vision_encoder.encoder = eager_encoder
+        replica.vision_compiled = replica.vision_tensorrt = False
+        probe = replica.submit_encode(warmup_vision_encoder).result()
+
+    # Verify the static decoder on a pool that holds one full-length sequence
+    # (and a padded pair in the smallest bucket), and only then allocate the
+    # full pool, so a decoder that rejects it (or a card without room for it)
+    # falls back to generate()
+    text_model = replica.model.text_model
+    try:
+        decoder = StaticDecoder(text_model, KVCachePool(text_model, max(2 * SEQ_BUCKETS[0], SEQ_BUCKETS[-1])))
+        replica.submit_decode(verify_static_decoder, decoder, probe).result()
+        capacity = max(kv_cache_capacity(replica), decoder.kv_caches.capacity)
+        if capacity > decoder.kv_caches.capacity:
+            decoder = None
+            decoder = StaticDecoder(text_model, KVCachePool(text_model, capacity))
+        if use_graphs:
+            print(f"Capturing decoder CUDA Graphs ({replica.device})...")
+            try:
+                replica.submit_decode(capture_decoder_graphs, decoder).result()
+                replica.submit_decode(verify_static_decoder, decoder, probe).result()
+            except Exception as e:
+                logger.warning(f"CUDA Graph capture failed, running decoder eagerly: {str(e)}")
+                decoder.release_graphs()
+        replica.decoder = decoder
+        print(f"Static decoder verified ({replica.device}, {capacity} KV tokens, "
+              f"CUDA Graphs {'on' if decoder.graphs_captured else 'off'})")
+    except Exception as e:
+        logger.warning(f"Static decoder unavailable, decoding with generate(): {str(e)}")
+        replica.decoder = None
+    return probe
+
+
+# The first replica's probe embedding sizes the image embedding pool
+probe_embeds = [prepare_replica(replica) for replica in replicas][0]
+encoded_images = ImageEmbeddingPool(
+    IMAGE_POOL_SLOTS, probe_embeds.shape[1:], probe_embeds.dtype, probe_embeds.device
+)
+
+
+class MicroBatcher(ABC):
+    """
+    Groups concurrent requests into batches for the model replicas.
+
+    Handlers submit their arguments and await the result. Each replica runs a
+    consumer task on the shared queue, so whichever replica is idle takes the
+    next batch. A consumer waits up to max_wait seconds after the first
+    request for more to arrive, then hands up to max_batch_size of them to
+    process().
+    """
+
+    def __init__(self, max_batch_size, max_wait):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.tasks = []
+
+    def start(self, replicas):
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.run(replica)) for replica in replicas]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def submit(self, *args):
+        """Queue a request and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((args, future))
+        return await future
+
+    async def next_batch(self):
+        """Wait for one request, then collect more until the batch is full or max_wait passes."""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self, replica):
+        while True:
+            batch = await self.next_batch()
+            try:
+                await self.process(batch, replica)
+            except Exception as e:
+                # Keep consuming; fail only this batch's requests rather than
+                # leaving every later request waiting on a dead consumer
+                logger.error(f"Error processing {type(self).__name__} batch: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    @abstractmethod
+    async def process(self, batch, replica):
+        """Run a batch on the replica and resolve each item's future."""
+
+    @staticmethod
+    async def resolve(batch, call):
+        """Await a replica call and resolve each item with its result."""
+        try:
+            results = await call
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return False
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        return True
+
+
+class EncodeBatcher(MicroBatcher):
+    """Encodes concurrently uploaded images with one vision encoder call."""
+
+    async def process(self, batch, replica):
+        images = [args[0] for args, _ in batch]
+        await self.resolve(batch, replica.encode(encode_images, images))
+
+
+class GenerationBatcher(MicroBatcher):
+    """
+    Answers concurrent questions with one batched decoder call.
+
+    Items are (image embedding, question, streamer). Streaming and
+    non-streaming requests are decoded together; each streamer only sees its
+    own row.
+    """
+
+    async def process(self, batch, replica):
+        image_embeds = [args[0] for args, _ in batch]
+        questions = [args[1] for args, _ in batch]
+        streamers = [args[2] for args, _ in batch]
+        answered = await self.resolve(
+            batch,
+            replica.decode(answer_questions, image_embeds, questions, MAX_NEW_TOKENS, streamers),
+        )
+        if not answered:
+            # Unblock the readers; decoding doesn't end the streams on failure
+            for streamer in streamers:
+                if streamer is not None:
+                    streamer.end()
+
+
+encode_batcher = EncodeBatcher(MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS / 1000)
+batcher = GenerationBatcher(MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS / 1000)
+
+
+# Uploads are hashed in chunks rather than read into memory whole
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def hash_image(image_file):
+    """Content hash of an upload, used as its image_key. Rewinds the file."""
+    digest = hashlib.blake2b(digest_size=16)
+    while chunk := image_file.read(HASH_CHUNK_BYTES):
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+
+def decode_image(image_file):
+    """Decode an uploaded image file into an RGB PIL image."""
+    return Image.open(image_file).convert('RGB')
+
+
+def prepare_image(image_file):
+    """
+    Decode and preprocess an upload for the vision encoder.
+
+    Moondream's resize/normalize runs here on the CPU, and the result is staged
+    in pinned memory in the model dtype so the replica that encodes it can
+    upload it asynchronously on its encode stream. The vision encoder skips
+    its own preprocessing for tensor inputs. Falls back to the PIL image when
+    there is no GPU or the encoder doesn't expose its preprocessing.
+    """
+    image = decode_image(image_file)
+    if not CUDA_AVAILABLE or not hasattr(model.vision_encoder, "preprocess"):
+        return image
+    pixels = model.vision_encoder.preprocess(image)
+    staged = torch.empty(pixels.shape, dtype=probe_embeds.dtype, pin_memory=True)
+    staged.copy_(pixels)
+    return staged
+
 
 @app.post("/describe")
 async def describe_image(file: UploadFile = File(...)):
@@ -86,47 +1238,124 @@ async def describe_image(file: UploadFile = File(...)):
         dict: Contains the image description and a key for accessing the cached encoding
             {
                 "description": str,
-                "image_key": str
+                "image_key": str,
+                "usage": {"prompt_tokens": int, "completion_tokens": int, "total_tokens": int}
             }
 
     Raises:
         HTTPException: If image processing fails
     """
     try:
-        print("\nGenerating description...")
-        # Read and process image
-        image_data = await file.read()
-        image = Image.open(io.BytesIO(image_data)).convert('RGB')
-        
-        # Generate description using Moondream model
-        with torch.inference_mode():
-            enc_image = model.encode_image(image)
-            
+        logger.debug("Generating description...")
+        # Hash the spooled upload in place instead of copying it into memory
+        image_key = await asyncio.to_thread(hash_image, file.file)
+
+        # The same image always produces the same description
+        cached = encoded_images.get_description(image_key)
+        if cached is not None:
+            description, usage = cached
+            return ORJSONResponse({
+                "description": description,
+                "image_key": image_key,
+                "usage": usage
+            })
+
+        acquired = encoded_images.acquire(image_key)
+        if acquired is None:
+            # Decode and preprocess off the event loop so concurrent uploads aren't
+            # serialized behind libjpeg, and the next image uploads while the GPU works
+            image = await asyncio.to_thread(prepare_image, file.file)
+
+            # Generate description using Moondream model
+            enc_image = await encode_batcher.submit(image)
+            slot = None
+
             # Store encoded image for future questions
-            image_key = str(time.time())
-            encoded_images[image_key] = enc_image
-            
-            description = model.answer_question(enc_image, "Describe this image.", tokenizer)
-            print(f"Generated description: {description}")
-        
-        if torch.cuda.is_available():
-            print(f"CUDA Memory Usage: {torch.cuda.memory_allocated(0) / 1024**2:.2f} MB")
+            encoded_images.store(image_key, enc_image)
+        else:
+            enc_image, slot = acquired
+
+        try:
+            description, usage = await batcher.submit(enc_image, "Describe this image.", None)
+        finally:
+            encoded_images.release(slot)
+        encoded_images.set_description(image_key, description, usage)
+        logger.debug("Generated description: %s", description)
+
+        if CUDA_AVAILABLE and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("CUDA Memory Usage: %.2f MB", torch.cuda.memory_allocated(0) / 1024**2)
         
         logger.info("Successfully processed image and generated description")
-        return {
+        return ORJSONResponse({
             "description": description,
-            "image_key": image_key
-        }
+            "image_key": image_key,
+            "usage": usage
+        })
         
     except Exception as e:
         error_msg = f"Error processing image: {str(e)}"
         logger.error(error_msg)
         raise HTTPException(status_code=500, detail=error_msg)
 
+
+def sse_event(payload):
+    """Encode a payload as a server-sent event."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+class AsyncTextStreamer(TextStreamer):
+    """
+    Streamer that hands decoded text from the decode thread to the event loop.
+
+    generate() calls it on the replica's decode thread; each chunk of text is
+    put on an asyncio queue with call_soon_threadsafe, so readers await it
+    without holding a thread for the life of the stream. Create it on the
+    event loop.
+    """
+
+    def __init__(self, tokenizer, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.loop = asyncio.get_running_loop()
+        self.text_queue = asyncio.Queue()
+
+    def on_finalized_text(self, text, stream_end=False):
+        self.loop.call_soon_threadsafe(self.text_queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.text_queue.put_nowait, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        text = await self.text_queue.get()
+        if text is None:
+            raise StopAsyncIteration
+        return text
+
+
+async def stream_answer(streamer, generation):
+    """Relay decoded text from a streamer as server-sent events."""
+    first = True
+    async for text in streamer:
+        if first:
+            text = text.lstrip()
+        if text:
+            first = False
+            yield sse_event({"token": text})
+    try:
+        _, usage = await generation
+        yield sse_event({"usage": usage})
+    except Exception as e:
+        logger.error(f"Error streaming answer: {str(e)}")
+        yield sse_event({"error": str(e)})
+    yield b"data: [DONE]\n\n"
+
+
 @app.post("/ask")
 async def ask_question(
     question: str = Form(...),
     image_key: str = Form(...),
+    stream: bool = Form(False),
 ):
     """
     Answer a question about a previously processed image.
@@ -134,50 +1363,120 @@ async def ask_question(
     Args:
         question (str): The question to answer about the image
         image_key (str): Key to retrieve the cached image encoding
+        stream (bool): Stream the answer as server-sent events while it is generated
 
     Returns:
         dict: Contains the model's answer
             {
-                "answer": str
+                "answer": str,
+                "usage": {"prompt_tokens": int, "completion_tokens": int, "total_tokens": int}
             }
+        or, when stream is true, a text/event-stream of
+            data: {"token": str}
+        events followed by a data: {"usage": {...}} event and "data: [DONE]"
 
     Raises:
         HTTPException: If image key not found or processing fails
     """
     try:
-        if image_key not in encoded_images:
+        # Get the encoded image, pinned in the pool until it has been decoded
+        acquired = encoded_images.acquire(image_key)
+        if acquired is None:
             raise HTTPException(status_code=400, detail="Image not found. Please upload the image again.")
-        
-        # Get the encoded image
-        enc_image = encoded_images[image_key]
+        enc_image, slot = acquired
         
         # Generate answer using Moondream model
-        with torch.inference_mode():
-            print(f"Generating answer for question: {question}")
-            answer = model.answer_question(enc_image, question, tokenizer)
-            print(f"Generated answer: {answer}")
+        logger.debug("Generating answer for question: %s", question)
+        if stream:
+            streamer = AsyncTextStreamer(tokenizer, skip_special_tokens=True)
+            generation = asyncio.ensure_future(batcher.submit(enc_image, question, streamer))
+            generation.add_done_callback(lambda _: encoded_images.release(slot))
+            return StreamingResponse(
+                stream_answer(streamer, generation), media_type="text/event-stream"
+            )
+        try:
+            answer, usage = await batcher.submit(enc_image, question, None)
+        finally:
+            encoded_images.release(slot)
+        logger.debug("Generated answer: %s", answer)
         
-        return {"answer": answer}
+        return ORJSONResponse({"answer": answer, "usage": usage})
         
     except Exception as e:
         logger.error(f"Error processing question: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Clean up old encoded images periodically
+async def sweep_encoded_images():
+    while True:
+        await asyncio.sleep(IMAGE_SWEEP_INTERVAL_SECONDS)
+        encoded_images.sweep(IMAGE_TTL_SECONDS)
+
 @app.on_event("startup")
+async def start_image_sweeper():
+    encoded_images.clear()
+    app.state.image_sweeper = asyncio.create_task(sweep_encoded_images())
+
 @app.on_event("shutdown")
-async def cleanup_encoded_images():
+async def stop_image_sweeper():
+    app.state.image_sweeper.cancel()
     encoded_images.clear()
 
+@app.on_event("shutdown")
+async def stop_log_listener():
+    log_listener.stop()
+
+@app.on_event("startup")
+async def start_batchers():
+    encode_batcher.start(replicas)
+    batcher.start(replicas)
+
+@app.on_event("shutdown")
+async def stop_batchers():
+    encode_batcher.stop()
+    batcher.stop()
+
 @app.get("/health")
-async def health_check():
+async def health_check(deep: bool = False):
     """
     Check system health and CUDA status
+
+    cuda_test maps each replica's device to the CUDA test result cached at
+    startup (empty without CUDA). Pass ?deep=true to re-run the probe on
+    every replica's GPU.
     """
-    return {
+    cuda_test = CUDA_TEST_RESULT
+    if deep and CUDA_AVAILABLE:
+        results = await asyncio.gather(
+            *(asyncio.to_thread(cuda_probe, replica.device) for replica in replicas)
+        )
+        cuda_test = {str(replica.device): result for replica, result in zip(replicas, results)}
+    # Caching allocator stats per replica device (empty without CUDA)
+    memory = {}
+    for replica in replicas if CUDA_AVAILABLE else []:
+        stats = torch.cuda.memory_stats(replica.device)
+        memory[str(replica.device)] = {
+            "allocated_bytes": stats.get("allocated_bytes.all.current", 0),
+            "peak_allocated_bytes": stats.get("allocated_bytes.all.peak", 0),
+            "reserved_bytes": stats.get("reserved_bytes.all.current", 0),
+            "num_alloc_retries": stats.get("num_alloc_retries", 0),
+        }
+    return ORJSONResponse({
         "status": "healthy",
         "model_loaded": model is not None,
         "tokenizer_loaded": tokenizer is not None,
-        "cuda_available": torch.cuda.is_available(),
-        "device": str(next(model.parameters()).device)
-    }
+        "cuda_available": CUDA_AVAILABLE,
+        "cuda_test": cuda_test,
+        "kv_cache_pool": all(replica.decoder is not None for replica in replicas),
+        "cuda_graphs": all(
+            replica.decoder is not None and replica.decoder.graphs_captured for replica in replicas
+        ),
+        "vision_compiled": all(replica.vision_compiled for replica in replicas),
+        "vision_tensorrt": all(replica.vision_tensorrt for replica in replicas),
+        "quantization": QUANT,
+        "device": MODEL_DEVICE,
+        "device_name": DEVICE_NAME,
+        "dtype": MODEL_DTYPE,
+        "replicas": [str(replica.device) for replica in replicas],
+        "cuda_memory": memory
+    })
@@ -0,0 +1,78 @@
+"""
+Export the Moondream vision encoder to a TensorRT engine.
+
+Traces the ViT stack (model.vision_encoder.encoder) to ONNX with a dynamic
+crop dimension, then builds an fp16 engine with trtexec. When the engine file
+exists, app.py runs image encoding through TensorRT instead of PyTorch; the
+projection and text decoder stay in PyTorch.
+
+Usage:
+    python export_tensorrt.py [--onnx moondream_vision.onnx] [--engine moondream_vision.plan]
+
+Requires a CUDA GPU and TensorRT's trtexec on the PATH.
+"""
+
+import argparse
+import subprocess
+
+import torch
+from transformers import AutoModelForCausalLM
+
+MODEL_ID = "vikhyatk/moondream2"
+REVISION = "2024-07-23"
+CROP_SIZE = 378
+# One global view plus up to four high-resolution crops per image, for a full batch of 8 images
+OPT_CROPS = 5
+MAX_CROPS = 40
+
+
+def export_onnx(onnx_path):
+    """Trace the ViT stack to ONNX with a dynamic number of crops."""
+    print("Loading model...")
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_ID,
+        trust_remote_code=True,
+        revision=REVISION,
+        torch_dtype=torch.float16,
+    ).to("cuda")
+    encoder = model.vision_encoder.encoder.eval()
+
+    print(f"Exporting vision encoder to {onnx_path}...")
+    dummy = torch.randn(1, 3, CROP_SIZE, CROP_SIZE, dtype=torch.float16, device="cuda")
+    with torch.inference_mode():
+        torch.onnx.export(
+            encoder,
+            (dummy,),
+            onnx_path,
+            input_names=["pixel_values"],
+            output_names=["image_features"],
+            dynamic_axes={"pixel_values": {0: "crops"}, "image_features": {0: "crops"}},
+            opset_version=17,
+        )
+
+
+def build_engine(onnx_path, engine_path):
+    """Build an fp16 TensorRT engine from the ONNX graph with trtexec."""
+    shape = f"3x{CROP_SIZE}x{CROP_SIZE}"
+    command = [
+        "trtexec",
+        f"--onnx={onnx_path}",
+        f"--saveEngine={engine_path}",
+        "--fp16",
+        f"--minShapes=pixel_values:1x{shape}",
+        f"--optShapes=pixel_values:{OPT_CROPS}x{shape}",
+        f"--maxShapes=pixel_values:{MAX_CROPS}x{shape}",
+    ]
+    print(f"Building TensorRT engine: {' '.join(command)}")
+    subprocess.run(command, check=True)
+    print(f"Saved TensorRT engine to {engine_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--onnx", default="moondream_vision.onnx", help="Intermediate ONNX file")
+    parser.add_argument("--engine", default="moondream_vision.plan", help="Output TensorRT engine")
+    args = parser.parse_args()
+
+    export_onnx(args.onnx)
+    build_engine(args.onnx, args.engine)